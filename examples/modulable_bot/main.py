@@ -22,68 +22,108 @@
 # License along with pypeul. If not, see <http://www.gnu.org/licenses/>.
 
 from pypeul import *
-from imp import reload
+from functools import lru_cache
+import importlib
 import sys
 
 class ModuleNotFound(Exception): pass
 
+# format codes used by the commands, resolved once
+COLOR_CODES = {name: str(getattr(Tags, name)) for name in Tags.colors}
+UNCOLOR = str(Tags.Uncolor)
+BOLD = Tags.Bold
+
+def module_names(modname):
+    """
+    Returns the handler key, the import name and the class name of a module
+    """
+    modname = modname.lower()
+    return modname, 'modules.' + modname, modname.title()
+
+@lru_cache(maxsize=128)
+def compile_admin_code(source, mode):
+    return compile(source, '<irc>', mode)
+
 class TestBot(IRC):
-    admins = ('jerrycraft.tk',)
+    admins = frozenset({'jerrycraft.tk'})
 
     def on_ready(self):
         self.join('#pypeul')
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.commands = {
+            '!colorize': self.cmd_colorize,
+            '!guess': self.cmd_guess,
+            '!load': self.cmd_load,
+            '!unload': self.cmd_unload,
+        }
+
+        self.admin_commands = {
+            '!dump': self.cmd_dump,
+            '!exec': self.cmd_exec,
+        }
+
     def on_message(self, umask, target, msg):
-        try:
-            if msg.startswith('!colorize '):
-                words = msg[10:].split()
-                self.message(target, ' '.join(str(
-                    (Tags.__getattr__(_.title()) if _.lower() in Tags.colors \
-                    else  _ + Tags.Uncolor)) for _ in words))
-
-            elif msg.startswith('!guess '):
-                guessed = list(map(lambda t: Tags.Bold(str(t)), self.nick_guess(msg[7:], target)))
-                if len(guessed) == 0:
-                    self.message(target, 'Connaît pas.')
-                elif len(guessed) == 1:
-                    self.message(target, 'Lol tu veux dire ' + guessed[0] + ' !')
-                else:
-                    self.message(target, 'Euh, tu veux dire ' +
-                        ', '.join(guessed[:-1]) + ' ou ' + guessed[-1] +  ' ?')
-
-            elif msg.startswith('!load '):
-                for modname in map(str.lower, msg[6:].split()):
-                    if not modname:
-                        continue
-                    try:
-                        self.load_module(modname)
-                        self.message(target, 'Module %s (re)loaded.' % Tags.Bold(modname))
-                    except ModuleNotFound:
-                        self.message(target, 'Module %s not found.' % Tags.Bold(modname))
-
-            elif msg.startswith('!unload '):
-                for modname in map(str.lower, msg[8:].split()):
-                    if not modname:
-                        continue
-                    try:
-                        self.unload_module(modname)
-                        self.message(target, 'Module %s unloaded.' % Tags.Bold(modname))
-                    except ModuleNotFound:
-                        self.message(target, 'Module %s not found.' % Tags.Bold(modname))
-
-            if umask.host not in self.admins:
-                return
-
-            if msg.startswith('!dump '):
-                self.message(target, eval(msg[6:]))
-
-            elif msg.startswith('!exec '):
-                exec(msg[6:], locals(), globals())
+        cmd, sep, args = msg.partition(' ')
+
+        if not sep:
+            return
+
+        handler = self.commands.get(cmd)
 
+        if handler is None and umask.host in self.admins:
+            handler = self.admin_commands.get(cmd)
+
+        if handler is None:
+            return
+
+        try:
+            handler(umask, target, args)
         except Exception as ex:
-            self.message(target, Tags.Bold('Exception : ') + repr(ex))
+            self.message(target, BOLD('Exception : ') + repr(ex))
             raise
 
+    def cmd_colorize(self, umask, target, args):
+        words = []
+        for word in args.split():
+            code = COLOR_CODES.get(word.lower())
+            words.append(code if code is not None else word + UNCOLOR)
+        self.message(target, ' '.join(words))
+
+    def cmd_guess(self, umask, target, args):
+        guessed = list(map(lambda t: BOLD(str(t)), self.nick_guess(args, target)))
+        if len(guessed) == 0:
+            self.message(target, 'Connaît pas.')
+        elif len(guessed) == 1:
+            self.message(target, 'Lol tu veux dire ' + guessed[0] + ' !')
+        else:
+            self.message(target, 'Euh, tu veux dire ' +
+                ', '.join(guessed[:-1]) + ' ou ' + guessed[-1] +  ' ?')
+
+    def cmd_load(self, umask, target, args):
+        for modname in map(str.lower, args.split()):
+            try:
+                self.load_module(modname)
+                self.message(target, 'Module %s (re)loaded.' % BOLD(modname))
+            except ModuleNotFound:
+                self.message(target, 'Module %s not found.' % BOLD(modname))
+
+    def cmd_unload(self, umask, target, args):
+        for modname in map(str.lower, args.split()):
+            try:
+                self.unload_module(modname)
+                self.message(target, 'Module %s unloaded.' % BOLD(modname))
+            except ModuleNotFound:
+                self.message(target, 'Module %s not found.' % BOLD(modname))
+
+    def cmd_dump(self, umask, target, args):
+        self.message(target, eval(compile_admin_code(args, 'eval')))
+
+    def cmd_exec(self, umask, target, args):
+        exec(compile_admin_code(args, 'exec'), locals(), globals())
+
     def on_ctcp_ping_request(self, umask, value):
         self.ctcp_reply(umask.nick, 'PING', value)
 
@@ -94,30 +134,45 @@ class TestBot(IRC):
         """
         Useful function that returns a list of 0, 1 or several possible users
         """
-        return [user for lnick, user in self.users.items() if irc_lower(part) in lnick and channel in user.channels]
+        part = irc_lower(part)
+        return [user for user in self.users.values()
+                if channel in user.channels and part in irc_lower(user.nick)]
 
     def load_module(self, modname):
-        modname = modname.lower()
+        modname, fullname, classname = module_names(modname)
 
         try:
-            if modname in self.handlers:
-                module = reload(sys.modules['modules.' + modname])
+            if fullname in sys.modules:
+                module = importlib.reload(sys.modules[fullname])
             else:
-                module = getattr(__import__('modules.' + modname), modname)
+                module = importlib.import_module(fullname)
 
-            self.handlers[modname] = getattr(module, modname.title())(self)
+            handler = getattr(module, classname)(self)
         except ImportError:
             raise ModuleNotFound
 
+        self.unload_handler(self.handlers.get(modname))
+        self.handlers[modname] = handler
+
     def unload_module(self, modname):
-        modname = modname.lower()
+        modname, fullname, classname = module_names(modname)
 
         try:
-            del sys.modules['modules.' + modname]
-            del self.handlers[modname]
+            del sys.modules[fullname]
+            handler = self.handlers.pop(modname)
         except KeyError:
             raise ModuleNotFound
 
+        self.unload_handler(handler)
+
+    def unload_handler(self, handler):
+        """
+        Lets a module handler stop what it started, e.g. its threads
+        """
+        unload = getattr(handler, 'unload', None)
+        if unload is not None:
+            unload()
+
 if __name__ == '__main__':
     # Enable debug-level logging
     import logging
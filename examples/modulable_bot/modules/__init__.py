@@ -0,0 +1,14 @@
+import functools
+
+def admin_only(func):
+    '''
+    Decorator for module callbacks taking an UserMask as first argument: the
+    callback is only called if the user is one of the bot admins.
+    '''
+
+    @functools.wraps(func)
+    def wrapper(self, umask, *args):
+        if umask.host in self.bot.admins:
+            return func(self, umask, *args)
+
+    return wrapper
@@ -21,36 +21,54 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with pypeul. If not, see <http://www.gnu.org/licenses/>.
 
+import logging
 import re
+import threading
+from collections import deque
 import urllib.request, urllib.parse, urllib.error
-import operator
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+
+@lru_cache(maxsize=256)
+def _find_next_re(numbers):
+    return re.compile(r'(?:^|,)' + ','.join(numbers) + r',(\d+)(?:,|$)')
 
 class Chain(object):
     class _BasicChain:
-        msg = ''
-        users = []
+        first_chars = None # any message may continue the chain
         repeats = 3
 
+        def __init__(self):
+            self.msg = ''
+            self.users = set()
+
         def handle(self, umask, target, msg):
             if self.msg != msg: # chain broken...
                 self.msg = msg
-                self.users = [umask.user]
+                self.users = {umask.user}
                 return
 
             if umask.user in self.users: # cheating user, just ignore him
                 return
 
-            self.users.append(umask.user)
+            self.users.add(umask.user)
 
             if len(self.users) == self.repeats:
                 return msg
 
     class _NumericChain:
-        numbers = []
+        first_chars = '+-.0123456789'
+        reg_number = re.compile(r'^\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\s*$')
         last_r = None
         repeats = 5
         special_seqs = {}
         url = 'http://oeis.org/search?q=%s&n=1&fmt=text&go=Search'
+        timeout = 10 # seconds, a hung request would hold a pool worker
+
+        def __init__(self):
+            self.numbers = deque(maxlen=self.repeats)
+            # last_r is also updated when a lookup completes, on the pool thread
+            self.lock = threading.Lock()
 
         def format_float(self, f):
             if round(f, 10) == int(f):
@@ -80,30 +98,32 @@ class Chain(object):
             return prev_r
 
         def get_special_seq(self, numbers):
-            numbers = numbers[:]
+            numbers = list(numbers)
             for i, number in enumerate(numbers):
                 if round(number, 10) != int(number):
                     return
                 numbers[i] = str(int(number))
 
-            find_re = re.compile('(?:^|,)' + ','.join(numbers) + ',(\d+)(?:,|$)')
+            find_re = _find_next_re(tuple(numbers))
             match = None
 
-            for id, seq in self.special_seqs.items():
+            # another lookup may be adding a sequence meanwhile
+            for id, seq in list(self.special_seqs.items()):
                 match = find_re.search(seq)
                 if match:
                     return id, match.group(1)
 
-            data = [line.split()[1:] for line in urllib.request.urlopen(
-                self.url % (','.join(numbers))
-                ).read().decode('utf-8').split('\n')
-                if line[:2] in ('%S', '%T', '%')]
+            # sequence lines look like '%S A000045 0,1,1,2,3,5,8,'
+            data = [line.split(None, 2) for line in urllib.request.urlopen(
+                self.url % (','.join(numbers)), timeout=self.timeout
+                ).read().decode('utf-8').splitlines()
+                if line[:2] in ('%S', '%T', '%U')]
 
             if not data:
                 return
 
-            id = data[0][0]
-            seq = ''.join(map(operator.itemgetter(1), data))
+            id = data[0][1]
+            seq = ''.join(line[2].strip() for line in data if len(line) == 3)
 
             match = find_re.search(seq)
 
@@ -113,16 +133,37 @@ class Chain(object):
             self.special_seqs[id] = seq
             return id, match.group(1)
 
-        def handle(self, umask, target, msg):
-            try:
-                self.numbers.append(float(msg))
-            except ValueError: # no number, no sequence
-                self.numbers = []
+        def skip(self, msg): # no number, no sequence
+            self.numbers.clear()
+            with self.lock:
                 self.last_r = None
+
+        def update_last_r(self, r):
+            """
+            Sets last_r to r, returns False if it was already r
+            """
+            with self.lock:
+                if self.last_r == r:
+                    return False
+                self.last_r = r
+                return True
+
+        def special_seq_found(self, found):
+            if found is None: # unknown sequence
+                with self.lock:
+                    self.last_r = None
                 return
 
-            if len(self.numbers) > self.repeats:
-                self.numbers.pop(0)
+            id, next = found
+            if self.update_last_r(('?', id)):
+                return next
+
+        def handle(self, umask, target, msg):
+            if not self.reg_number.match(msg):
+                self.skip(msg)
+                return
+
+            self.numbers.append(float(msg))
 
             if len(self.numbers) < self.repeats:
                 return
@@ -131,38 +172,30 @@ class Chain(object):
             mul_r = self.get_reason('*', self.numbers)
 
             if add_r:
-                if self.last_r == ('+', add_r):
+                if not self.update_last_r(('+', add_r)):
                     return
 
                 ret = self.format_float(self.numbers[-1] + add_r)
-                self.last_r = ('+', add_r)
-                self.numbers = []
+                self.numbers.clear()
                 return ret
 
             elif mul_r:
-                if self.last_r == ('*', mul_r):
+                if not self.update_last_r(('*', mul_r)):
                     return
 
                 ret =  self.format_float(self.numbers[-1] * mul_r)
-                self.last_r = ('*', mul_r)
-                self.numbers = []
+                self.numbers.clear()
                 return ret
 
             else:
-                try:
-                    id, next = self.get_special_seq(self.numbers)
-                except TypeError:
-                    self.last_r = None
-                    return
-
-                if self.last_r == ('?', id):
-                    return
-
-                self.last_r = ('?', id)
-                self.numbers = []
-                return next
+                # too slow to answer now: the lookup only gets its own copy
+                # of the numbers, Chain runs it on its pool
+                numbers = list(self.numbers)
+                self.numbers.clear()
+                return partial(self.get_special_seq, numbers)
 
     class _CompleteChain:
+        first_chars = None
         complete = {
             'koi': 'feur',
             'alo': 'alo',
@@ -171,14 +204,24 @@ class Chain(object):
             'sava': 'œ',
          }
 
+        def __init__(self):
+            # messages are stripped and lowered before lookup, keys must be too
+            self.complete = {key.strip().lower(): value
+                             for key, value in self.complete.items()}
+            self.max_len = max(map(len, self.complete))
+
         def handle(self, umask, target, msg):
-            msg = msg.lower().strip()
+            msg = msg.strip()
+            if len(msg) > self.max_len: # can't be a known key, skip lower()
+                return
+
+            msg = msg.lower()
             if msg in self.complete:
                 return self.complete[msg]
 
 
     class _AccumulationChain:
-        reg_d = re.compile(r'^:(\s*)(d|p)$', re.I)
+        first_chars = ':'
 
         def find_shortest_pattern(self, msg):
             # TODO have fun
@@ -189,14 +232,25 @@ class Chain(object):
             pass
 
         def handle(self, umask, target, msg):
-            rd = self.reg_d.match(msg.strip())
-            if rd:
-                rdg = rd.groups()
-                return ':%s%s' % ('-'*len(rdg[0]), rdg[1])
+            # ':d', ': p', ':   D'...
+            msg = msg.strip()
+            if len(msg) < 2 or msg[0] != ':' or msg[-1] not in 'dpDP':
+                return
+
+            spaces = msg[1:-1]
+            if spaces and not spaces.isspace():
+                return
+
+            return ':%s%s' % ('-'*len(spaces), msg[-1])
+
+        def skip(self, msg):
+            pass
 
     def __init__(self, bot):
         self.bot = bot
         self.handlers = []
+        # OEIS lookups are slow: run them off the IRC thread
+        self._pool = ThreadPoolExecutor(max_workers=2)
 
         for chain in ('Basic', 'Accumulation', 'Complete', 'Numeric'):
             inst = getattr(self, '_' + chain + 'Chain')()
@@ -204,8 +258,36 @@ class Chain(object):
             self.handlers.append(inst)
 
     def on_message(self, umask, target, msg):
+        first = msg.lstrip()[:1]
+
         for handler in self.handlers:
+            if handler.first_chars and not (first and
+                                            first in handler.first_chars):
+                handler.skip(msg) # this message can't match, don't parse it
+                continue
+
             output = handler.handle(umask, target, msg)
+            if callable(output): # answer when the lookup is done
+                future = self._pool.submit(output)
+                future.add_done_callback(partial(self.reply_later, handler,
+                                                 target))
+                return
             if output:
                 self.bot.message(target, output)
                 return
+
+    def unload(self):
+        self._pool.shutdown(wait=False)
+
+    def reply_later(self, handler, target, future):
+        # called on the pool thread, a failed lookup is an unknown sequence
+        error = future.exception()
+        if error is not None:
+            logging.getLogger(__name__).warning('Sequence lookup failed',
+                                                exc_info=error)
+            output = handler.special_seq_found(None)
+        else:
+            output = handler.special_seq_found(future.result())
+
+        if output:
+            self.bot.message(target, output)
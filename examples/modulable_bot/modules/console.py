@@ -23,6 +23,7 @@ import sys
 from io import StringIO
 from threading import Thread, RLock
 from queue import Queue
+from modules import admin_only
 
 class RedirectedStream(object):
     def __init__(self, original):
@@ -38,6 +39,14 @@ class RedirectedStream(object):
         self.redirect = self.original
         self.lock.release()
 
+    def write(self, data):
+        with self.lock:
+            return self.redirect.write(data)
+
+    def flush(self):
+        with self.lock:
+            return self.redirect.flush()
+
     def __getattr__(self, name):
         self.lock.acquire()
         ret = getattr(self.redirect, name)
@@ -47,6 +56,8 @@ class RedirectedStream(object):
 sys.stdout = RedirectedStream(sys.__stdout__)
 
 class IRCConsole(code.InteractiveConsole):
+    STOP = object() # pushed to read_buffer to end the console
+
     def __init__(self, bot, user):
         super().__init__({'bot': bot})
         self.bot = bot
@@ -63,30 +74,31 @@ class IRCConsole(code.InteractiveConsole):
             sys.stdout.redirect_end()
 
     def write(self, data):
-        self.write_buffer += data
+        *lines, self.write_buffer = (self.write_buffer + data).split('\n')
 
-        while '\n' in self.write_buffer:
-            self.bot.message(self.user, self.write_buffer.split('\n')[0])
-            self.write_buffer = '\n'.join(self.write_buffer.split('\n')[1:])
+        for line in lines:
+            self.bot.message(self.user, line)
 
     def raw_input(self, prompt=''):
         if prompt:
             self.write(prompt + '\n')
-        return self.read_buffer.get()
+        line = self.read_buffer.get()
+        if line is self.STOP:
+            raise SystemExit
+        return line
 
     def shutdown(self):
-        self.thread._stop()
-        self.thread.join()
+        # the console thread exits the next time it waits for input; don't
+        # join it, it may still be running some code
+        self.read_buffer.put(self.STOP)
 
 class Console(object):
     def __init__(self, bot):
         self.bot = bot
         self.consoles = {}
 
+    @admin_only
     def on_message(self, umask, target, msg):
-        if umask.host not in self.bot.admins:
-            return
-
         user = umask.user
 
         if msg == '!console':
@@ -27,6 +27,7 @@ from pypeul import Tags
 
 XMLRPC = 'http://paste.pocoo.org/xmlrpc/'
 SHOW = 'http://paste.pocoo.org/show/%s/'
+MAX_SIZE = 1024 * 1024
 
 class Lodgeit(object):
     def __init__(self, bot):
@@ -61,10 +62,18 @@ class Lodgeit(object):
                 self.bot.message(target, out)
 
     def paste(self, fn, private):
-        if '..' in fn:
-            raise AttributeError
+        base = os.path.realpath('.')
+        path = os.path.realpath(os.path.join(base, fn))
 
-        fn = './' + fn
+        if os.path.commonpath([base, path]) != base:
+            raise PermissionError('%s is outside of the bot directory' % fn)
 
-        id = self.lodgeit.pastes.newPaste(None, open(fn).read(), None, fn, None, private)
+        with open(path, 'rb') as f:
+            data = f.read(MAX_SIZE + 1)
+
+        if len(data) > MAX_SIZE:
+            raise IOError('%s is too large' % fn)
+
+        data = data.decode('utf-8', 'replace')
+        id = self.lodgeit.pastes.newPaste(None, data, None, fn, None, private)
         return id
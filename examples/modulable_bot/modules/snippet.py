@@ -22,29 +22,35 @@
 # License along with pypeul. If not, see <http://www.gnu.org/licenses/>.
 
 from pypeul import Tags
+from modules import admin_only
 
 class Snippet(object):
     def __init__(self, bot):
         self.bot = bot
         self.snippets = {}
 
+    @admin_only
     def on_message(self, umask, target, msg):
-        if umask.host not in self.bot.admins:
+        if not msg.startswith(('!snip ', '!unsnip ', '.')):
             return
 
-        parts = msg.split()
-        if msg.startswith('!snip ') and len(parts) >= 3:
-            self.snippets[parts[1]] = ' '.join(parts[2:])
+        # the body keeps its inner spacing, it is Python code
+        parts = msg.rstrip().split(None, 2)
+        cmd = parts[0]
+        key = parts[1] if len(parts) > 1 else ''
+        body = parts[2] if len(parts) > 2 else ''
 
-        if msg.startswith('!unsnip ') and len(parts) >= 2:
+        if cmd == '!snip' and key and body:
+            self.snippets[key] = body
+
+        elif cmd == '!unsnip' and key:
             try:
-                del self.snippets[parts[1]]
+                del self.snippets[key]
             except KeyError:
                 pass
 
-        if msg.startswith('.') and parts[0][1:] in self.snippets:
+        elif cmd[:1] == '.' and cmd[1:] in self.snippets:
             try:
-                exec(self.snippets[parts[0][1:]], locals(), globals())
+                exec(self.snippets[cmd[1:]], locals(), globals())
             except Exception as ex:
                 self.bot.message(target, Tags.Bold('Exception: ') + repr(ex))
-
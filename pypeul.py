@@ -24,15 +24,19 @@
 __version__ = 'Pypeul python IRC client library v0.3.2 by Mick@el & Zopieux'
 
 ENCODING = 'utf-8'
+# used to decode incoming text that isn't valid in ENCODING
+FALLBACK_ENCODING = 'iso-8859-15'
 
 import socket
 import threading
 import re
+import string
 import sys
 import io
 import logging
-from collections import namedtuple, UserDict, OrderedDict
-from collections.abc import Callable
+from collections import namedtuple, deque, OrderedDict
+from collections.abc import ItemsView, KeysView
+from functools import lru_cache, wraps
 from textwrap import wrap
 import time
 
@@ -49,15 +53,28 @@ def threaded(func):
 logger = logging.getLogger(__name__)
 
 
+# Only ASCII letters are case-folded
+IRC_LOWER_TABLE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+# Nicks and channel names keep coming back, cache their lowercase form
+@lru_cache(maxsize=4096)
 def irc_lower(s):
-    # TODO: better implementation
-    return s.encode('utf-8').lower().decode('utf-8')
+    # TODO: honour the CASEMAPPING advertised by the server
+    return s.translate(IRC_LOWER_TABLE)
 
 
 def irc_equals(s1, s2):
     return irc_lower(s1) == irc_lower(s2)
 
 
+# The same few commands come in over and over: cache their interned
+# uppercase form
+@lru_cache(maxsize=256)
+def _command_upper(cmd):
+    return sys.intern(cmd.upper())
+
+
 class Tags:
     '''
     This class is used to represent mIRC-style formatted text
@@ -94,6 +111,8 @@ class Tags:
             Tags.Red(Tags.Blue("...")) will be blue '''
 
     RE_COLOR = re.compile(r'\x03(\d{1,2})?(?:,(\d{1,2})?)?')
+    # any format code, with the color numbers if any
+    RE_FORMAT = re.compile(r'[\x02\x1f\x16\x0f]|' + RE_COLOR.pattern)
     colors = {
         'white': '00',
         'black': '01',
@@ -126,12 +145,22 @@ class Tags:
 
     formats_names = list(formats.keys())
     formats_codes = list(formats.values())
+    strip_table = str.maketrans('', '', ''.join(formats_codes))
+
+    color_names_by_code = {int(v): k for k, v in colors.items()}
+    formats_names_by_code = {v: k for k, v in formats.items()}
 
     def color_name_by_code(self, n):
-        return self.color_names[self.color_codes.index(n)]
+        try:
+            return self.color_names_by_code[n]
+        except KeyError:
+            raise ValueError('unknown color code %r' % n) from None
 
     def format_name_by_code(self, code):
-        return self.formats_names[self.formats_codes.index(code)]
+        try:
+            return self.formats_names_by_code[code]
+        except KeyError:
+            raise ValueError('unknown format code %r' % code) from None
 
     keywords = tuple(colors) + tuple(formats)
 
@@ -140,11 +169,7 @@ class Tags:
         Strip all mIRC formatting codes in a string
         '''
 
-        text = Tags.RE_COLOR.sub('', text)
-        for val in Tags.formats.values():
-            text = text.replace(val, '')
-
-        return text
+        return Tags.RE_COLOR.sub('', text).translate(Tags.strip_table)
 
     def parse(self, text):
         '''
@@ -153,17 +178,14 @@ class Tags:
 
         chunks = []
         chunk = Tags.Chunk()
-        i = 0
+        pos = 0
 
-        while i < len(text):
-            char = text[i]
-
-            try:
-                fmt = self.format_name_by_code(char)
-            except ValueError:
-                fmt = None
+        for match in self.RE_FORMAT.finditer(text):
+            chunk.text += text[pos:match.start()]
+            pos = match.end()
+            fmt = self.format_name_by_code(match.group(0)[0])
 
-            if fmt and chunk.text:
+            if chunk.text:
                 chunks.append(chunk)
                 chunk = Tags.Chunk()
                 chunk.tags |= chunks[-1].tags - {'reset', 'uncolor'}
@@ -176,7 +198,6 @@ class Tags:
                 chunk.tags = set()
 
             if fmt == 'uncolor':
-                match = self.RE_COLOR.search(text[i:])
                 fg, bg = match.groups()
 
                 if fg:
@@ -188,19 +209,14 @@ class Tags:
                     chunk.bgcolor = ''
                     chunk.tags.add('uncolor')
 
-                i += len(match.group(0))
                 continue
 
-            if fmt:
-                if fmt in chunk.tags:
-                    chunk.tags.remove(fmt)
-                else:
-                    chunk.tags.add(fmt)
+            if fmt in chunk.tags:
+                chunk.tags.remove(fmt)
             else:
-                chunk.text += char
-
-            i += 1
+                chunk.tags.add(fmt)
 
+        chunk.text += text[pos:]
         chunks.append(chunk)
         return self.ChunkList(chunks)
 
@@ -218,10 +234,11 @@ class Tags:
 
         return keyword, name
 
-    def __getattr__(self, name):
+    def __getattr__(self, attr):
         fgcolor = ''
         bgcolor = ''
         formats = set()
+        name = attr
 
         while name:
             keyword, name = self._next_keyword(name)
@@ -256,21 +273,28 @@ class Tags:
             def __radd__(self, other):
                 return str(other) + str(self)
 
-        return Tag()
+        # tags are immutable: store it so that next lookups of the same name
+        # don't go through __getattr__ again
+        tag = self.__dict__[attr] = Tag()
+        return tag
 
     class ChunkList:
         def __init__(self, children=None, fgcolor='', bgcolor='', tags=None):
-            children = children or []
+            Chunk, ChunkList = Tags.Chunk, Tags.ChunkList
             self.children = []
+            append = self.children.append
 
-            for child in children:
-                if isinstance(child, Tags.Chunk):
-                    self.children.append(child)
+            for child in children or ():
+                if isinstance(child, Chunk):
+                    append(child)
 
-                elif isinstance(child, Tags.ChunkList):
+                elif isinstance(child, ChunkList):
                     self.children.extend(child.children)
                 else:
-                    self.children.append(Tags.Chunk(str(child)))
+                    append(Chunk(str(child)))
+
+            if not (fgcolor or bgcolor or tags):
+                return  # nothing to propagate to the children
 
             for child in self.children:
                 if 'reset' not in child.tags and 'uncolor' not in child.tags:
@@ -316,28 +340,38 @@ class Tags:
         def split_words(self):
             new_chunklist = Tags.ChunkList()
 
+            append = new_chunklist.children.append
+
             for chunk in self.children:
                 words = chunk.text.split(' ')
+                last = words.pop()
 
-                for i, word in enumerate(words):
+                for word in words:
                     newchunk = chunk.copy()
                     newchunk.text = word + ' '
+                    append(newchunk)
 
-                    if i == len(words) - 1:
-                        newchunk.text = newchunk.text[:-1]
-                    new_chunklist.children.append(newchunk)
+                newchunk = chunk.copy()
+                newchunk.text = last
+                append(newchunk)
 
             return new_chunklist
 
         def __str__(self):
             return self.to_string(end=True)
 
-        def to_string(self, end=False):
+        def _render(self):
+            '''
+            Yield the formatted text of each chunk, along with the codes
+            needed to close the formatting left open after it
+            '''
             fg, bg = '', ''
             tags = set()
-            ret = ''
+            last = ''  # last character rendered so far
 
             for chunk in self.children:
+                ret = ''
+
                 for tag in (tags ^ chunk.tags):
                     ret += Tags.formats[tag]
 
@@ -355,38 +389,52 @@ class Tags:
                     if chunk.bgcolor and bg != chunk.bgcolor:
                         ret += ',' + Tags.colors[chunk.bgcolor]
 
-                if ret.endswith(Tags.formats['uncolor']) and (
+                if (ret[-1:] or last) == Tags.formats['uncolor'] and (
                         chunk.text[:1].isdigit() or
                         chunk.text[:1] == ','):
                     ret += 2 * Tags.formats['bold']  # workaround
 
                 ret += chunk.text
+                last = ret[-1:] or last
 
                 fg, bg = chunk.fgcolor, chunk.bgcolor
                 tags = chunk.tags.copy() - {'reset', 'uncolor'}
 
-            if end:
+                end = ''
                 if fg or bg:
-                    ret += Tags.formats['uncolor']
+                    end += Tags.formats['uncolor']
                 for tag in tags - {'uncolor', 'reset'}:
-                    ret += Tags.formats[tag]
+                    end += Tags.formats[tag]
+
+                yield ret, end
+
+        def to_string(self, end=False):
+            ret = []
+            closing = ''
 
-            return ret
+            for text, closing in self._render():
+                ret.append(text)
+
+            if end:
+                ret.append(closing)
+
+            return ''.join(ret)
 
     class Chunk:
-        fgcolor = ''
-        bgcolor = ''
-        tags = None
+        __slots__ = ('text', 'fgcolor', 'bgcolor', 'tags')
 
         def __init__(self, text=''):
             self.text = text
+            self.fgcolor = ''
+            self.bgcolor = ''
             self.tags = set()
 
         def copy(self):
-            other = Tags.Chunk(self.text)
-            other.tags = self.tags.copy()
+            other = object.__new__(Tags.Chunk)
+            other.text = self.text
             other.fgcolor = self.fgcolor
             other.bgcolor = self.bgcolor
+            other.tags = self.tags.copy()
             return other
 
         def __repr__(self):
@@ -403,6 +451,24 @@ class Tags:
 Tags = Tags()
 
 
+def config_property(func):
+    '''
+    Read-only property of ServerConfig, computed once and cached until the
+    configuration changes
+    '''
+    name = func.__name__
+
+    @wraps(func)
+    def getter(self):
+        try:
+            return self._cache[name]
+        except KeyError:
+            value = self._cache[name] = func(self)
+            return value
+
+    return property(getter)
+
+
 class ServerConfig:
     '''
     This classed is used to allow easy access to the RPL_ISUPPORT line returned
@@ -417,24 +483,26 @@ class ServerConfig:
             'MAXLIST': 'beI:10',  # arbitrary
             'MODES': '3',
         }
+        self._cache = {}
 
     def __getitem__(self, item):
         return self.info[item]
 
     def __setitem__(self, item, value):
         self.info[item] = value
+        self._cache.clear()
 
     def __contains__(self, item):
         return item in self.info
 
-    @property
+    @config_property
     def chan_prefixes(self):
         """
         Returns the possible channel prefixes characters
         """
-        return set(self.info['CHANTYPES'])
+        return frozenset(self.info['CHANTYPES'])
 
-    @property
+    @config_property
     def chan_modes(self):
         '''
         This is a list of channel modes according to 4 types.
@@ -449,9 +517,9 @@ class ServerConfig:
         Note: Some clients assumes that any mode not listed is of type D.
         Note: Modes in PREFIX are not listed but could be considered type B.
         '''
-        return [set(_) for _ in self.info['CHANMODES'].split(',')]
+        return tuple(frozenset(_) for _ in self.info['CHANMODES'].split(','))
 
-    @property
+    @config_property
     def max_lists_entries(self):
         '''
         Maximum number of entries in the list for each mode.
@@ -464,15 +532,15 @@ class ServerConfig:
 
         return ret
 
-    @property
+    @config_property
     def list_modes(self):
         '''
         A set of all type A modes (that add or remove to a list
         such as a ban list)
         '''
-        return set(self.max_lists_entries.keys()) | self.chan_modes[0]
+        return frozenset(self.max_lists_entries.keys()) | self.chan_modes[0]
 
-    @property
+    @config_property
     def prefixes(self):
         '''
         A list of channel modes a person can get and the respective prefix a
@@ -488,21 +556,30 @@ class ServerConfig:
         left, right = self.info['PREFIX'].split(')')
         return OrderedDict(zip(left[1:], right))
 
+    @config_property
+    def modes_by_prefix(self):
+        '''
+        A dict of prefix -> mode, the reverse of prefixes
+        '''
+        return {prefix: mode for mode, prefix in self.prefixes.items()}
+
     def mode_for_prefix(self, prefix):
         '''
         Get the mode for the given prefix
         '''
-        index = list(self.prefixes.values()).index(prefix[0])
-        return list(self.prefixes.keys())[index]
+        try:
+            return self.modes_by_prefix[prefix[0]]
+        except KeyError:
+            raise ValueError('unknown prefix %r' % prefix[0]) from None
 
-    @property
+    @config_property
     def prefixes_modes(self):
         '''
         A set containing all the channel modes a person can get
         '''
-        return set(self.prefixes.keys())
+        return frozenset(self.prefixes.keys())
 
-    @property
+    @config_property
     def max_modes(self):
         '''
         Maximum number of channel modes with a parameter
@@ -510,43 +587,84 @@ class ServerConfig:
         '''
         return int(self.info['MODES'])
 
-    @property
+    @config_property
     def param_modes(self):
         '''
         A set of all type B modes (which always have a parameter associated)
         '''
-        return set(self.chan_modes[1]) | self.prefixes_modes
+        return self.chan_modes[1] | self.prefixes_modes
 
-    @property
+    @config_property
     def param_set_modes(self):
         '''
         A set of all type C modes (which always have a parameter when set)
         '''
-        return set(self.chan_modes[2])
+        return self.chan_modes[2]
+
+    @config_property
+    def unset_param_modes(self):
+        '''
+        A set of all the modes which take a parameter when unset
+        '''
+        return self.param_modes | self.list_modes
+
+    @config_property
+    def set_param_modes(self):
+        '''
+        A set of all the modes which take a parameter when set
+        '''
+        return self.unset_param_modes | self.param_set_modes
+
+    @config_property
+    def user_modes(self):
+        '''
+        A set of the channel modes tracked per user: prefix modes and list
+        modes without a MAXLIST entry
+        '''
+        return self.prefixes_modes | (self.list_modes
+                                      - set(self.max_lists_entries))
 
-    @property
+    @config_property
     def noparam_modes(self):
         '''
         A set of all type D modes (which never have a parameter associated)
         '''
-        return set(self.chan_modes[3])
+        return self.chan_modes[3]
 
 
 class IRC:
     def __init__(self, thread_callbacks=False):
         self.thread_callbacks = thread_callbacks
+        self.encoding = ENCODING
+        self.fallback_encoding = FALLBACK_ENCODING
         self.connected = False
         self.enabled = True
 
         self.bans = IrcDict()
         self.users = IrcDict()
+        # channel -> {User: None}, a dict so members keep their join order
+        self.channel_users = IrcDict()
         self.myself = None
         self.serverconf = ServerConfig()
         self.handlers = {}
         self.send_lock = threading.RLock()
 
+        # internal processing of server messages, by command
+        self.command_handlers = {
+            'PING': self._handle_ping,
+            'NICK': self._handle_nick,
+            'welcome': self._handle_welcome,
+            'featurelist': self._handle_featurelist,
+            'banlist': self._handle_banlist,
+            'endofbanlist': self._handle_endofbanlist,
+            'namreply': self._handle_namreply,
+            'PRIVMSG': self._handle_privmsg,
+            'NOTICE': self._handle_notice,
+            'MODE': self._handle_mode,
+        }
+
         self.fsock = None
-        self.waiting_queue = []
+        self.waiting_queue = deque()
 
         self.reconnect_obj = None
 
@@ -557,7 +675,14 @@ class IRC:
         return irc_equals(str(user), str(self.myself))
 
     def users_in(self, channel):
-        return [u for u in self.users.values() if u.is_in(channel)]
+        return list(self.channel_users.get(channel, ()))
+
+    def _user_for_nick(self, nick):
+        # only go through UserMask when the User has to be created
+        user = self.users.get(nick)
+        if user is None:
+            user = UserMask(self, nick).user
+        return user
 
     def connect(self, host, port=6667, use_ssl=False):
         '''Etablish a connection to a server'''
@@ -566,6 +691,8 @@ class IRC:
         self.host = host
         self.port = port
         self.sk = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # lines are small and interactive, don't let Nagle delay them
+        self.sk.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         if use_ssl:
             import ssl
@@ -591,7 +718,8 @@ class IRC:
 
     def run_loop(self):
         while self.enabled:
-            for waiting_msg in self.waiting_queue:
+            while self.waiting_queue:
+                waiting_msg = self.waiting_queue.popleft()
                 if waiting_msg is None:
                     return
                 try:
@@ -600,8 +728,6 @@ class IRC:
                     logger.exception(
                             "Exception raised while processing a message")
 
-            self.waiting_queue = []
-
             txt = self.get_raw_message()
             if txt is None:
                 break
@@ -627,7 +753,7 @@ class IRC:
                 else:
                     raise TypeError("reconnect: not a number nor a callable")
 
-                logger.info('Trying to reconnect in {}s.'.format(t))
+                logger.info('Trying to reconnect in %ss.', t)
                 time.sleep(t)
                 i += 1
 
@@ -637,7 +763,7 @@ class IRC:
                                self.myself.realname, self.myself.password)
                     break
                 except Exception as e:
-                    logger.error('Reconnect failed: {}.'.format(e))
+                    logger.error('Reconnect failed: %s.', e)
 
             self.run()
 
@@ -654,13 +780,24 @@ class IRC:
 
         This method is thread-safe
         '''
+        self.raw_lines((raw,))
+
+    def raw_lines(self, lines):
+        '''
+        Send several raw strings to server, in a single write
+
+        This method is thread-safe
+        '''
+        data = b''.join(line.encode(self.encoding) + b'\r\n' for line in lines)
+
         with self.send_lock:
-            self.sk.send(raw.encode(ENCODING) + b'\r\n')
+            self.sk.sendall(data)
 
-            logger.debug('> ' + raw)
+            for line in lines:
+                logger.debug('> %s', line)
 
     def _get_prefix(self, params):
-        prefix = ''
+        prefix = []
 
         for prm in params:
             prm = str(prm)
@@ -674,10 +811,9 @@ class IRC:
             if ' ' in prm or prm[0] == ':':
                 raise ValueError("space or ':' prefix in non-last argument")
 
-            prefix += prm + ' '
+            prefix.append(prm)
 
-        prefix = prefix[:-1]  # remove trailing space
-        return prefix
+        return ' '.join(prefix)
 
     def send(self, *params, last=''):
         """
@@ -698,7 +834,8 @@ class IRC:
         else:
             last = str(last)
 
-        last = ' '.join(x.strip('\r') for x in last.split('\n'))
+        if '\n' in last or '\r' in last:
+            last = ' '.join(x.strip('\r') for x in last.split('\n'))
 
         if last:
             self.raw(prefix + ' :' + last)
@@ -727,14 +864,13 @@ class IRC:
         prefix = self._get_prefix(params)
 
         if no_break:
-            if isinstance(last, Formats.ChunkList):
+            if isinstance(last, Tags.ChunkList):
                 last = last.to_string()
             else:
                 last = str(last)
 
-            with self.send_lock:
-                for line in last.split('\n'):
-                    self.raw(prefix + ' :' + line)
+            self.raw_lines([prefix + ' :' + line
+                            for line in last.split('\n')])
             return
 
         # FIXME: might be too small if you have a long nickname
@@ -752,10 +888,18 @@ class IRC:
             while next_chunks:
                 nb_chunks = len(next_chunks)
 
+                # rendered length of the first n chunks, for each n, from a
+                # single rendering of the whole line
+                lengths = []
+                length = 0
+
+                for text, end in Tags.ChunkList(next_chunks)._render():
+                    length += len(text)
+                    lengths.append(length + len(end))
+
                 # try to fit the maximum number of complete chunks
                 for complete_chunks in range(nb_chunks, 0, -1):
-                    left_chunks = Tags.ChunkList(next_chunks[:complete_chunks])
-                    length = len(str(left_chunks))
+                    length = lengths[complete_chunks - 1]
 
                     if length <= max_limit:  # it fits!
                         break
@@ -775,9 +919,7 @@ class IRC:
                 lines.append(chunklist.to_string())
                 next_chunks = next_chunks[complete_chunks:]
 
-        with self.send_lock:
-            for line in lines:
-                self.raw(prefix + ' :' + line)
+        self.raw_lines([prefix + ' :' + line for line in lines])
 
     def ident(self, nick, ident=None,
             realname=__version__, password=None):
@@ -876,17 +1018,18 @@ class IRC:
             return
 
         j = 0
+        max_modes = self.serverconf.max_modes
 
         while j < len(m):
             cur_sign = None
             modenames = ''
             modevals = []
+            # len(target + modenames + ' '.join(modevals)), kept up to date
+            length = len(target)
 
             i = 0
 
-            while len(target + modenames + ' '.join(modevals)) < 450 \
-                and i < self.serverconf.max_modes and j < len(m):
-
+            while length < 450 and i < max_modes and j < len(m):
                 if isinstance(m[j], str):
                     name = m[j]
                     val = None
@@ -896,11 +1039,16 @@ class IRC:
                 if cur_sign != name[0]:
                     cur_sign = name[0]
                     modenames += name[0]
+                    length += 1
 
                 modenames += name[1:]
+                length += len(name) - 1
 
                 if val:
-                    modevals += [val]
+                    if modevals:
+                        length += 1
+                    modevals.append(val)
+                    length += len(val)
 
                 i += 1
                 j += 1
@@ -939,8 +1087,6 @@ class IRC:
     def get_banlist(self, chan, timeout=0):
         banlist = self.get_list(chan, ('MODE', chan, '+b'), 'banlist',
                 timeout=timeout)
-        if not chan in self.bans:
-            self.bans[chan] = []
         self.bans[chan] = banlist
         return banlist
 
@@ -964,46 +1110,43 @@ class IRC:
             return string
 
         try:
-            return string.decode('ascii')
+            return string.decode(self.encoding)
         except UnicodeDecodeError:
-            try:
-                return string.decode('utf-8')
-            except UnicodeDecodeError:
-                return string.decode('iso-8859-15', 'replace')
+            return string.decode(self.fallback_encoding, 'replace')
 
     def parse_modes(self, modestr, targets):
-        last = None
+        add = None
         i = 0
         out = []
+        append = out.append
+
+        unset_param_modes = self.serverconf.unset_param_modes
+        set_param_modes = self.serverconf.set_param_modes
 
         for char in modestr:
             if char in '+-':
-                last = char
+                add = char == '+'
+                param_modes = set_param_modes if add else unset_param_modes
                 continue
 
-            if last is None:
+            if add is None:
                 raise ValueError("Modes have to begin with + or -")
 
-            param_modes = (self.serverconf.param_modes |
-                           self.serverconf.list_modes)
-            if last == '+':
-                param_modes |= self.serverconf.param_set_modes
-
             if char in param_modes:
-                out.append((last == '+', char, targets[i]))
+                append((add, char, targets[i]))
                 i += 1
             else:
-                out.append((last == '+', char, None))
+                append((add, char, None))
         return out
 
     def _callback(self, name, *parameters):
-        for inst in [self] + list(self.handlers.values()):
+        for inst in (self, *self.handlers.values()):
             f = getattr(inst, name, None)
 
-            if not isinstance(f, Callable):
+            if not callable(f):
                 continue
 
-            logger.debug('calling %s() on instance %r' % (name, inst))
+            logger.debug('calling %s() on instance %r', name, inst)
 
             if self.thread_callbacks or getattr(f, 'threaded', None):
                 t = threading.Thread(target=f, args=parameters)
@@ -1012,51 +1155,56 @@ class IRC:
             else:
                 f(*parameters)
 
-    def _parse_message(self, text):
-        text = text.strip(b'\r\n')
-        text = list(map(self.to_unicode, text.split(b' ')))
-        logger.debug('< ' + ' '.join(text))
+    @staticmethod
+    def _split_message(text):
+        prefix = None
 
-        prefix = ''
+        if text.startswith(':'):  # Prefix parsing
+            prefix, _, text = text[1:].partition(' ')
 
-        umask = None
+        # Parameters parsing: everything after the first ' :' is the last
+        # parameter, which can contain spaces
+        text, sep, last = text.partition(' :')
+        params = text.split(' ')
 
-        if text[0].startswith(':'):  # Prefix parsing
-            prefix = text[0][1:]
-            text = text[1:]
+        if sep:
+            params.append(last)
 
-            umask = UserMask(self, prefix)
+        return prefix, params
 
-        if len(text) > 1:
-            cmd = text[0]
-            prms = text[1:]
-        else:
-            cmd = text[0]
-            prms = []
+    def _parse_message(self, text):
+        text = text.strip(b'\r\n')
 
-        # Parameters parsing
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('< %s', self.to_unicode(text))
 
-        params = []
-        last = False
+        try:
+            # Most lines are valid: decode them once, as a whole
+            text = text.decode(self.encoding)
+        except UnicodeDecodeError:
+            # Mixed encodings, even within the trailing parameter: decode
+            # each word on its own
+            text = ' '.join(map(self.to_unicode, text.split(b' ')))
 
-        for prm in prms:
-            if prm.startswith(':') and not last:
-                last = True
-                prm = prm[1:]
-                params.append(prm)
+        prefix, params = self._split_message(text)
+        cmd, *params = params
 
-            elif last:
-                params[len(params) - 1] += ' ' + prm
+        if not cmd:  # empty line or lone prefix, there is nothing to handle
+            logger.warning('Ignoring a message without a command: %r', text)
+            return None, None, []
 
-            else:
-                params.append(prm)
+        umask = UserMask(self, prefix) if prefix is not None else None
 
-        cmd = numeric_events.get(cmd, cmd.upper())
+        # interned, so the command table lookups hit on identity
+        cmd = numeric_events.get(cmd) or _command_upper(cmd)
         return umask, cmd, params
 
     def _process_message(self, text):
         umask, cmd, params = self._parse_message(text)
 
+        if cmd is None:
+            return
+
         if cmd in ('JOIN', 'PART', 'KICK'):
             self._callback('on_pre_server_' + cmd.lower(), umask, *params)
 
@@ -1072,125 +1220,152 @@ class IRC:
 
         self._callback('on_server_' + cmd.lower(), umask, *params)
 
-        if cmd == 'PING':
-            self.send('PONG', last=params[0])
+        handler = self.command_handlers.get(cmd)
 
-        elif cmd == 'NICK' and umask:
-            oldnick, newnick = umask.user.nick, params[0]
-            self.users.rename_key(oldnick, newnick)
-            umask.user.nick = newnick
+        # handlers return False when they don't apply to this message
+        if handler is None or handler(umask, params) is False:
+            if umask and self.is_me(umask):
+                self._callback('on_self_' + cmd.lower(), *params)
 
-        elif cmd == 'welcome':
-            self._callback('on_ready')
+    def _handle_ping(self, umask, params):
+        self.send('PONG', last=params[0])
 
-        elif cmd == 'featurelist':  # Server configuration string
-            for i, param in enumerate(params[1:]):
-                if i == len(params):
-                    break
+    def _handle_nick(self, umask, params):
+        if not umask:
+            return False
 
-                try:
-                    name, value = param.split('=')
-                    self.serverconf[name] = value
+        oldnick, newnick = umask.user.nick, params[0]
 
-                except ValueError:
-                    self.serverconf[param] = True
+        # a User still known under the new nick is stale: drop it rather
+        # than leaving it in channel_users once rename_key replaces it
+        stale = self.users.get(newnick)
+        if stale is not None and stale is not umask.user:
+            stale.delete()
 
-                    if param == 'NAMESX':
-                        self.send('PROTOCTL', 'NAMESX')
+        self.users.rename_key(oldnick, newnick)
+        umask.user.nick = newnick
 
-        elif cmd == 'banlist':
-            chan = params[1]
+    def _handle_welcome(self, umask, params):
+        self._callback('on_ready')
 
-            if not chan in self.bans:
-                self.bans[chan] = []
+    def _handle_featurelist(self, umask, params):
+        # Server configuration string
+        for i, param in enumerate(params[1:]):
+            if i == len(params):
+                break
+
+            try:
+                name, value = param.split('=')
+                self.serverconf[name] = value
 
-            self.bans[chan].append(params[2:])
+            except ValueError:
+                self.serverconf[param] = True
 
-        elif cmd == 'endofbanlist':
-            chan = params[1]
-            self._callback('on_banlist_received', chan, self.bans[chan])
+                if param == 'NAMESX':
+                    self.send('PROTOCTL', 'NAMESX')
 
-        elif cmd == 'namreply':
-            channel = params[2]
+    def _handle_banlist(self, umask, params):
+        chan = params[1]
+        self.bans.setdefault(chan, []).append(params[2:])
 
-            for raw_nick in params[3].split():
-                modes = [self.serverconf.mode_for_prefix(_) for _ in raw_nick
-                         if _ in self.serverconf.prefixes.values()]
+    def _handle_endofbanlist(self, umask, params):
+        chan = params[1]
+        self._callback('on_banlist_received', chan, self.bans[chan])
 
-                nick = raw_nick[len(modes):]
-                user = UserMask(self, nick).user
-                user.joined(channel)
-                user.channels[channel] = set(modes)
+    def _handle_namreply(self, umask, params):
+        channel = params[2]
+        modes_by_prefix = self.serverconf.modes_by_prefix
 
-        elif cmd == 'PRIVMSG':
-            if params[1].startswith('\1') and params[1].endswith('\1'):
-                name = params[1][1:][:-1]
-                value = None
+        for raw_nick in params[3].split():
+            # prefixes come first, the nick starts at the first other char
+            modes = []
+            for char in raw_nick:
+                mode = modes_by_prefix.get(char)
+                if mode is None:
+                    break
+                modes.append(mode)
 
-                pos = name.find(' ')
-                if pos > -1:
-                    name, value = name[:pos], name[pos + 1:]
+            nick = raw_nick[len(modes):]
+            user = self._user_for_nick(nick)
+            user.joined(channel)
+            user.channels[channel] = set(modes)
 
-                if name == 'ACTION':
-                    self._callback('on_action', umask, params[0], value)
-                else:
-                    self._callback('on_ctcp_request', umask, name, value)
-                    self._callback('on_ctcp_' + name.lower() + '_request',
-                            umask, value)
-            else:
-                self._callback('on_message', umask, *params)
+    @staticmethod
+    def _split_ctcp(text):
+        # '\1NAME value\1' -> ('NAME', 'value'), value being None if absent
+        end = len(text) - 1
+        pos = text.find(' ', 1, end)
 
-                if self.is_channel(params[0]):
-                    self._callback('on_channel_message', umask, *params)
+        if pos < 0:
+            return text[1:end], None
 
-                elif self.is_me(params[0]):
-                    self._callback('on_private_message', umask, params[1])
+        return text[1:pos], text[pos + 1:end]
 
-        elif cmd == 'NOTICE' and umask is not None:
-            if params[1].startswith('\1') and params[1].endswith('\1'):
-                name = params[1][1:][:-1]
-                value = None
+    def _handle_privmsg(self, umask, params):
+        text = params[1]
 
-                pos = name.find(' ')
-                if pos > -1:
-                    name, value = name[:pos], name[pos + 1:]
+        if text and text[0] == '\1' == text[-1]:
+            name, value = self._split_ctcp(text)
 
-                self._callback('on_ctcp_reply', umask, name, value)
-                self._callback('on_ctcp_' + name.lower() + '_reply', umask,
-                        value)
+            if name == 'ACTION':
+                self._callback('on_action', umask, params[0], value)
             else:
-                self._callback('on_notice', umask, *params)
+                self._callback('on_ctcp_request', umask, name, value)
+                self._callback('on_ctcp_' + name.lower() + '_request',
+                        umask, value)
+        else:
+            self._callback('on_message', umask, *params)
 
-                if self.is_channel(params[0]):
-                    self._callback('on_channel_notice', umask, *params)
+            if self.is_channel(params[0]):
+                self._callback('on_channel_message', umask, *params)
 
-                elif self.is_me(params[0]):
-                    self._callback('on_private_notice', umask, params[1])
+            elif self.is_me(params[0]):
+                self._callback('on_private_message', umask, text)
 
-        elif (cmd == 'MODE' and umask and len(params) > 2 and
-             self.is_channel(params[0])):
-            chan = params[0]
-            modestr = params[1]
-            targets = params[2:]
+    def _handle_notice(self, umask, params):
+        if umask is None:
+            return False
+
+        text = params[1]
+
+        if text and text[0] == '\1' == text[-1]:
+            name, value = self._split_ctcp(text)
+
+            self._callback('on_ctcp_reply', umask, name, value)
+            self._callback('on_ctcp_' + name.lower() + '_reply', umask,
+                    value)
+        else:
+            self._callback('on_notice', umask, *params)
+
+            if self.is_channel(params[0]):
+                self._callback('on_channel_notice', umask, *params)
+
+            elif self.is_me(params[0]):
+                self._callback('on_private_notice', umask, text)
+
+    def _handle_mode(self, umask, params):
+        if not (umask and len(params) > 2 and self.is_channel(params[0])):
+            return False
 
-            for add, mode, value in self.parse_modes(modestr, targets):
-                if mode in (self.serverconf.prefixes_modes
-                            | self.serverconf.list_modes
-                            - set(self.serverconf.max_lists_entries)):
-                    user = UserMask(self, value).user
-                    mode_set = user.modes_in(chan)
+        chan = params[0]
+        modestr = params[1]
+        targets = params[2:]
+        user_modes = self.serverconf.user_modes
 
-                    if add:
-                        mode_set.add(mode)
-                    elif mode in mode_set:
-                        mode_set.remove(mode)
+        for add, mode, value in self.parse_modes(modestr, targets):
+            if mode in user_modes:
+                user = self._user_for_nick(value)
+                mode_set = user.modes_in(chan)
 
-        elif umask and self.is_me(umask):
-            self._callback('on_self_' + cmd.lower(), *params)
+                if add:
+                    mode_set.add(mode)
+                elif mode in mode_set:
+                    mode_set.remove(mode)
 
 
 class UserMask:
-    maskRegex = re.compile(r'([^!]+)!([^@]+)@(.+)')
+    # one of these is built for every prefixed message
+    __slots__ = ('irc', 'nick', 'ident', 'host', 'user')
 
     def __init__(self, irc, mask):
         self.irc = irc
@@ -1200,16 +1375,20 @@ class UserMask:
         self.user = None
         mask = str(mask)
 
-        match = self.maskRegex.match(mask)
+        # nick!ident@host, each part being non-empty
+        bang = mask.find('!')
+        at = mask.find('@', bang + 1)
 
-        if match:
-            self.nick, self.ident, self.host = match.groups()
+        if 0 < bang and bang + 1 < at < len(mask) - 1:
+            self.nick = mask[:bang]
+            self.ident = mask[bang + 1:at]
+            self.host = mask[at + 1:]
         else:
             self.nick = mask
 
-        if self.nick in self.irc.users:
-            self.user = self.irc.users[self.nick]
+        self.user = self.irc.users.get(self.nick)
 
+        if self.user is not None:
             if self.host and self.host != self.user.host:
                 self.user.host = self.host  # host can change (mode x)
             if self.ident and not self.user.ident:
@@ -1257,24 +1436,35 @@ class User:
             return
 
         self.channels[channel] = set()
+        self.irc.channel_users.setdefault(channel, {})[self] = None
 
     def left(self, channel):
         if self.deleted:
             logger.error("left() called on a deleted user")
             return
 
-        if not self.is_in(channel):
-            return
         try:
             del self.channels[channel]
         except KeyError:
-            pass
+            return
+
+        self._unindex(channel)
 
     def delete(self):
+        for channel in self.channels:
+            self._unindex(channel)
+
         self.channels = IrcDict()
         self.deleted = True
         del self.irc.users[self.nick]
 
+    def _unindex(self, channel):
+        members = self.irc.channel_users[channel]
+        members.pop(self, None)
+
+        if not members:
+            del self.irc.channel_users[channel]
+
     def __repr__(self):
         return '<{0}User: {1}!{2}@{3}>'.format('Deleted ' if self.deleted else
                 '', self.nick, self.ident, self.host)
@@ -1283,34 +1473,103 @@ class User:
         return self.nick
 
 
-class NormalizedDict(UserDict):
+class NormalizedDict(dict):
+    '''
+    A dict whose keys are normalized with function() on every access.
+
+    Values are stored under the normalized key, so a lookup costs a single
+    dict access. The first spelling given for each key is kept aside and
+    is what iterating over the dict returns.
+    '''
     function = staticmethod(str.lower)
 
     def __init__(self, *args, **kwargs):
-        self._map = {}
-        super(NormalizedDict, self).__init__(*args, **kwargs)
+        super(NormalizedDict, self).__init__()
+        self._keys = {}
+        self.update(*args, **kwargs)
 
     def __contains__(self, key):
-        return self.function(key) in self._map
+        return dict.__contains__(self, self.function(key))
 
     def __getitem__(self, key):
-        return self.data[self._map[self.function(key)]]
+        return dict.__getitem__(self, self.function(key))
 
     def __setitem__(self, key, value):
-        if key in self:
-            self.data[self._map[self.function(key)]] = value
-        else:
-            self._map[self.function(key)] = key
-            self.data[key] = value
+        nkey = self.function(key)
+        self._keys.setdefault(nkey, key)
+        dict.__setitem__(self, nkey, value)
 
     def __delitem__(self, key):
-        del self.data[self._map[self.function(key)]]
-        del self._map[self.function(key)]
+        nkey = self.function(key)
+        dict.__delitem__(self, nkey)
+        del self._keys[nkey]
+
+    def __iter__(self):
+        return iter(self._keys.values())
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def keys(self):
+        return KeysView(self)
+
+    def items(self):
+        return ItemsView(self)
+
+    def get(self, key, default=None):
+        return dict.get(self, self.function(key), default)
+
+    def setdefault(self, key, default=None):
+        nkey = self.function(key)
+        self._keys.setdefault(nkey, key)
+        return dict.setdefault(self, nkey, default)
+
+    def pop(self, key, *default):
+        nkey = self.function(key)
+        self._keys.pop(nkey, None)
+        return dict.pop(self, nkey, *default)
+
+    def popitem(self):
+        nkey, value = dict.popitem(self)
+        return self._keys.pop(nkey), value
+
+    def clear(self):
+        dict.clear(self)
+        self._keys.clear()
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def copy(self):
+        return type(self)(self.items())
+
+    def __or__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        new = self.copy()
+        new.update(other)
+        return new
+
+    def __ror__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        new = type(self)(other)
+        new.update(self)
+        return new
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    __copy__ = copy
+
+    def __reduce__(self):
+        # the dict contents alone would lose the original key spellings
+        return type(self), (list(self.items()),)
 
     def rename_key(self, oldkey, newkey):
-        val = self[oldkey]
-        del self[oldkey]
-        self[newkey] = val
+        self[newkey] = self.pop(oldkey)
 
 
 class IrcDict(NormalizedDict):
@@ -0,0 +1,55 @@
+import unittest
+
+from pypeul import IRC, IrcDict
+
+
+class StateTest(unittest.TestCase):
+    def setUp(self):
+        self.irc = IRC()
+
+    def feed(self, *lines):
+        for line in lines:
+            self.irc._process_message(line.encode('utf-8'))
+
+    def test_nick_onto_tracked_nick(self):
+        self.feed(':Alice!u@h JOIN #a', ':Bob!u@h JOIN #a',
+                  ':Bob!u@h NICK Alice')
+
+        alice = self.irc.users['Alice']
+        self.assertEqual(self.irc.users_in('#a'), [alice])
+        self.assertEqual(list(self.irc.users), ['Alice'])
+
+        self.feed(':Alice!u@h PART #a')
+        self.assertEqual(self.irc.users_in('#a'), [])
+
+    def test_lone_prefix_ignored(self):
+        events = []
+        self.irc._callback = lambda name, *args: events.append(name)
+
+        with self.assertLogs('pypeul', 'WARNING'):
+            self.feed(':irc.server', ':irc.server ', '')
+
+        self.assertEqual(events, [])
+        self.assertEqual(list(self.irc.users), [])
+
+    def test_users_in_join_order(self):
+        nicks = ['nick%d' % i for i in range(20)]
+        self.feed(*(':%s!u@h JOIN #a' % nick for nick in nicks))
+
+        self.assertEqual([user.nick for user in self.irc.users_in('#a')],
+                         nicks)
+
+
+class IrcDictTest(unittest.TestCase):
+    def test_union_normalizes_keys(self):
+        d = IrcDict(Foo=1)
+        d |= {'FOO': 2, 'Bar': 3}
+
+        self.assertEqual(list(d), ['Foo', 'Bar'])
+        self.assertEqual(d['foo'], 2)
+        self.assertIsInstance(d | {'baz': 4}, IrcDict)
+        self.assertEqual(list({'baz': 4} | d), ['baz', 'Foo', 'Bar'])
+
+
+if __name__ == '__main__':
+    unittest.main()